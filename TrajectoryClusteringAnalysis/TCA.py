@@ -1,17 +1,225 @@
+import hashlib
 import pandas as pd
 import plotly.graph_objects as go
-from scipy.cluster.hierarchy import  dendrogram,linkage,fcluster
+from scipy.cluster.hierarchy import  dendrogram,linkage,fcluster,optimal_leaf_ordering
 from scipy.cluster import hierarchy
 import matplotlib.pyplot as plt
+from matplotlib.colors import ListedColormap
 from scipy.spatial.distance import pdist
 import numpy as np
 import seaborn as sns
 from logger import logging
 #import logging
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+try:
+    from fastcluster import linkage as _linkage
+except ImportError:
+    _linkage = None
 
 ##########
 
 
+if hasattr(np, 'bitwise_count'):
+    _popcount = np.bitwise_count
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def _popcount(words):
+        return _POPCOUNT_TABLE[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def _hamming_packed(data, block_size=256, max_states=64):
+    """
+    Compute the condensed Hamming distance matrix of categorical sequences using bit-packed rows.
+
+    Each cell is one-hot encoded over the state alphabet and every row is packed into uint64 words,
+    so that two cells that differ contribute exactly two set bits to the XOR of their rows.
+
+    Parameters:
+    data (numpy.ndarray): A (patients, time) array of states.
+    block_size (int): Number of rows compared at once, keeps the XOR buffers cache resident. Default is 256.
+    max_states (int): Largest alphabet packed, the one-hot encoding takes patients * time * states bits. Default is 64.
+
+    Returns:
+    numpy.ndarray: The condensed float32 distance matrix, in the same order as scipy's pdist,
+    or None if the alphabet is larger than max_states or contains missing values (pdist counts two NaNs as different).
+    """
+    n, t = data.shape
+    states, codes = np.unique(data, return_inverse=True)
+    if len(states) > max_states or pd.isna(states).any():
+        return None
+    codes = codes.reshape(n, t)
+    one_hot = codes[:, :, None] == np.arange(codes.max() + 1)
+    packed = np.packbits(one_hot.reshape(n, -1), axis=1)
+    packed = np.pad(packed, ((0, 0), (0, -packed.shape[1] % 8)))
+    # One row of uint64 words per 64 bits of the packed sequences, shape (words, patients)
+    words = np.ascontiguousarray(np.ascontiguousarray(packed).view(np.uint64).T)
+
+    distance_matrix = np.empty(n * (n - 1) // 2, dtype=np.float32)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        counts = np.zeros((stop - start, n - start), dtype=np.uint32)
+        for word in words:
+            counts += _popcount(word[start:stop, None] ^ word[None, start:])
+        for i in range(start, stop):
+            k = i * (2 * n - i - 1) // 2
+            distance_matrix[k:k + n - i - 1] = counts[i - start, i - start + 1:]
+    distance_matrix /= np.float32(2 * t)
+    return distance_matrix
+
+
+def _as_int32(values):
+    """
+    Convert an array of states to a contiguous int32 array.
+
+    Parameters:
+    values (numpy.ndarray): A (patients, time) array of states.
+
+    Returns:
+    numpy.ndarray: The int32 array, or None if the states are not integers.
+    """
+    try:
+        with np.errstate(invalid='ignore'):
+            int_values = np.ascontiguousarray(values, dtype=np.int32)
+    except (TypeError, ValueError):
+        return None
+    if not np.array_equal(int_values, values):
+        return None
+    return int_values
+
+
+def _digest(values):
+    """
+    Compute a short digest of the content of an array, used as a cache key.
+
+    Parameters:
+    values (numpy.ndarray): The array to hash.
+
+    Returns:
+    bytes: An 8 bytes blake2b digest, or None for object arrays which have no stable byte content.
+    """
+    if values.dtype == object:
+        return None
+    return hashlib.blake2b(np.ascontiguousarray(values).view(np.uint8), digest_size=8).digest()
+
+
+def _byte_codes(values):
+    """
+    Recode the states to uint8 codes when the alphabet fits in a byte, so that the hamming kernel compares one byte per cell.
+
+    Parameters:
+    values (numpy.ndarray): A (patients, time) integer array of states.
+
+    Returns:
+    numpy.ndarray: The (patients, time) uint8 codes, or values unchanged if there are more than 256 states.
+    """
+    states, codes = np.unique(values, return_inverse=True)
+    if len(states) > 256:
+        return values
+    return np.ascontiguousarray(codes.reshape(values.shape), dtype=np.uint8)
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _hamming_row(X, i, out):
+        """
+        Fill the distances between row i and the rows after it in the condensed matrix out.
+        """
+        n, t = X.shape
+        k = i * (2 * n - i - 1) // 2
+        for j in range(i + 1, n):
+            c = 0
+            for s in range(t):
+                c += X[i, s] != X[j, s]
+            out[k + j - i - 1] = np.float32(c) / np.float32(t)
+
+    @njit(parallel=True, cache=True)
+    def _pdist_hamming_int(X):
+        """
+        Compute the condensed Hamming distance matrix of integer sequences in parallel over the rows.
+        Row i has n - i - 1 pairs, so each iteration takes rows i and n - 1 - i to give every thread the same amount of work.
+
+        Parameters:
+        X (numpy.ndarray): A contiguous (patients, time) integer array.
+
+        Returns:
+        numpy.ndarray: The condensed float32 distance matrix, in the same order as scipy's pdist.
+        """
+        n = X.shape[0]
+        out = np.empty(n * (n - 1) // 2, np.float32)
+        for i in prange((n + 1) // 2):
+            _hamming_row(X, i, out)
+            if n - 1 - i != i:
+                _hamming_row(X, n - 1 - i, out)
+        return out
+else:
+    _pdist_hamming_int = None
+
+
+def _partition_by_cluster(clusters):
+    """
+    Group the patient indices by cluster label with a single stable sort.
+
+    Parameters:
+    clusters (numpy.ndarray): The cluster assignments for each patient.
+
+    Returns:
+    list: Index arrays indexed by cluster label, each in the original patient order.
+    """
+    clusters = np.asarray(clusters)
+    order = np.argsort(clusters, kind='stable')
+    return np.split(order, np.cumsum(np.bincount(clusters))[:-1])
+
+
+def _cluster_grid(num_clusters):
+    """
+    Create the figure used by the per-cluster plots, two clusters per row.
+
+    Parameters:
+    num_clusters (int): The number of clusters to plot.
+
+    Returns:
+    fig (matplotlib.figure.Figure): The figure.
+    axs (numpy.ndarray): A 2-D array of axes, cluster k is drawn on axs.flat[k - 1].
+    """
+    num_rows = (num_clusters + 1) // 2
+    num_cols = min(2, num_clusters)
+    fig, axs = plt.subplots(num_rows, num_cols, figsize=(15, 10), squeeze=False)
+    if num_clusters > 1 and num_clusters % 2 != 0:
+        fig.delaxes(axs[-1, -1])
+    return fig, axs
+
+
+def _state_percentages(arr, states):
+    """
+    Compute the percentage of patients under each state over time, among the patients who go through the state.
+
+    Parameters:
+    arr (numpy.ndarray): A (patients, time) array of states.
+    states (numpy.ndarray): The states to count.
+
+    Returns:
+    numpy.ndarray: A (states, time) array of percentages, 0 for the states that never occur.
+    """
+    n, t = arr.shape
+    is_integer = np.issubdtype(arr.dtype, np.integer) and np.issubdtype(states.dtype, np.integer)
+    num_values = max(arr.max(initial=0), states.max()) + 1 if is_integer else 0
+    if 0 < num_values <= 4 * len(states) and min(arr.min(initial=0), states.min()) >= 0:
+        # Dense small alphabet: count every value of every column, and of every patient, with one bincount each
+        column_counts = np.bincount((arr + np.arange(t) * num_values).ravel(), minlength=t * num_values).reshape(t, num_values)
+        patient_counts = np.bincount((arr + (np.arange(n) * num_values)[:, None]).ravel(), minlength=n * num_values).reshape(n, num_values)
+        counts = column_counts[:, states].T
+        denom = (patient_counts[:, states] > 0).sum(axis=0)[:, None]
+    else:
+        # Compare every state in a single pass: eq has shape (patients, states, time)
+        eq = arr[:, None, :] == states[None, :, None]
+        counts = eq.sum(axis=0)
+        denom = eq.any(axis=2).sum(axis=0)[:, None]
+    return np.divide(counts * 100.0, denom, out=np.zeros(counts.shape), where=denom > 0)
+
 
 class TCA:
     def __init__(self, data, state_mapping, colors='viridis'):
@@ -19,13 +227,95 @@ class TCA:
         self.state_label = list(state_mapping.keys())
         self.state_numeric = list(state_mapping.values())
         self.colors = colors
+        self._last_linkage = None
         logging.basicConfig(level=logging.INFO)
         
         if len(self.colors) != len(self.state_label):
             logging.error("Number of colors and states mismatch")
             raise ValueError("The number of colors must match the number of states")
         logging.info("TCA object initialized successfully")
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        # Reassigning the data drops the arrays derived from it
+        self._data = data
+        self._arr_cache = None
+        self._last_pct = None
+        self._last_dist = None
+
+    def _states(self):
+        """
+        Return the contiguous int32 copy of the states (the raw values when the states are not integers), shared by the distance and plotting code.
+        The copy is checked against the shape and digest of the live data on every call, and rebuilt when they differ,
+        so in-place edits of data (iloc assignments, drop(..., inplace=True)) are seen.
+
+        Returns:
+        key (tuple): The shape, dtype and digest of the states, the digest is None when the data cannot be hashed.
+        arr (numpy.ndarray): The (patients, time) array of states.
+        """
+        values = np.asarray(self.data)
+        # Object frames (e.g. DataFrame.replace with pandas 3) are hashed through their int32 conversion
+        int_values = _as_int32(values) if values.dtype == object else None
+        hashed = values if int_values is None else int_values
+        key = (hashed.shape, hashed.dtype.str, _digest(hashed))
+        if self._arr_cache is None or key[2] is None or self._arr_cache[0] != key:
+            if int_values is None:
+                int_values = _as_int32(values)
+            self._arr_cache = (key, values if int_values is None else int_values)
+        return self._arr_cache
+
+    @property
+    def _arr(self):
+        """
+        The (patients, time) array of states of the current data, see _states.
+        """
+        return self._states()[1]
+
+    @property
+    def _cols(self):
+        """
+        The time labels, the column names of a DataFrame or the column positions of an array.
+        """
+        columns = getattr(self.data, 'columns', None)
+        if columns is None:
+            return np.arange(np.shape(self.data)[1])
+        return np.asarray(columns)
         
+    def _cluster_state_percentages(self, clusters):
+        """
+        Compute the percentage of patients under each state over time for each cluster.
+        The result for the last clusters seen is kept, so that successive plots of the same clustering share it.
+
+        Parameters:
+        clusters (numpy.ndarray): The cluster assignments for each patient.
+
+        Returns:
+        numpy.ndarray: A (clusters, states, time) array of percentages, cluster k is at index k - 1.
+        """
+        clusters = np.asarray(clusters)
+        state_key, arr = self._states()
+        key = (state_key, clusters.dtype.str, clusters.tobytes())
+        if state_key[2] is not None and self._last_pct is not None and self._last_pct[0] == key:
+            return self._last_pct[1]
+
+        num_clusters = len(np.unique(clusters))
+        states = np.asarray(self.state_numeric)
+        # Sum the state masks of every cluster at once with a matrix product against the (clusters, patients) membership matrix
+        membership = np.ascontiguousarray(clusters[None, :] == np.arange(1, num_clusters + 1)[:, None], dtype=np.float32)
+        counts = np.empty((num_clusters, len(states), arr.shape[1]))
+        denom = np.empty((num_clusters, len(states), 1))
+        for i, treatment in enumerate(states):
+            eq = arr == treatment
+            counts[:, i] = membership @ eq.astype(np.float32)
+            denom[:, i, 0] = membership @ eq.any(axis=1).astype(np.float32)
+        percentages = np.divide(counts * 100.0, denom, out=np.zeros(counts.shape), where=denom > 0)
+
+        self._last_pct = (key, percentages)
+        return percentages
 
     def plot_treatment_percentages(self, clusters=None ):
         """
@@ -41,17 +331,11 @@ class TCA:
             raise ValueError("self.data should be a pandas DataFrame")
         if clusters is None:
            
-            df = self.data.copy()
-            # Initialize an empty list to store data for plotting
-            plot_data = []
-
-            # Collect data for each treatment
-            for treatment, treatment_label,color in zip(self.state_numeric, self.state_label,self.colors):
-                treatment_data = df[df.eq(treatment).any(axis=1)]
-                months = treatment_data.columns
-                percentages = (treatment_data.apply(lambda x: x.value_counts().get(treatment, 0)) / len(treatment_data)) * 100
-                plot_data.append(pd.DataFrame({'Month': months, 'Percentage': percentages, 'Treatment': treatment_label}))
-                plt.plot(months, percentages, label=f'{treatment_label}', color=color)
+            months = self._cols
+            # Compute the percentages of all the states at once, the loop only draws
+            percentages = _state_percentages(self._arr, np.asarray(self.state_numeric))
+            for i, (treatment_label, color) in enumerate(zip(self.state_label, self.colors)):
+                plt.plot(months, percentages[i], label=f'{treatment_label}', color=color)
 
             plt.title('Percentage of Patients under Each State Over Time')
             plt.xlabel('Time')
@@ -61,32 +345,19 @@ class TCA:
 
         else :
             num_clusters = len(np.unique(clusters))
+            cluster_percentages = self._cluster_state_percentages(clusters)
             colors = self.colors
-            events_value = self.state_numeric
             events_keys = self.state_label
-            num_rows = (num_clusters + 1) // 2
-            num_cols = min(2, num_clusters)
-
-            fig, axs = plt.subplots(num_rows, num_cols, figsize=(15, 10))
-            if num_clusters == 2:
-                axs = np.array([axs])
-            if num_clusters % 2 != 0:
-                fig.delaxes(axs[-1, -1])
+            fig, axs = _cluster_grid(num_clusters)
 
+            months = self._cols
             for cluster_label in range(1, num_clusters + 1):
-                cluster_indices = np.where(clusters == cluster_label)[0]
-                cluster_data = self.data.iloc[cluster_indices]
-
-                row = (cluster_label - 1) // num_cols
-                col = (cluster_label - 1) % num_cols
+                percentages = cluster_percentages[cluster_label - 1]
 
-                ax = axs[row, col]
+                ax = axs.flat[cluster_label - 1]
 
-                for treatment, treatment_label, color in zip(events_value, events_keys, colors):
-                    treatment_data = cluster_data[cluster_data.eq(treatment).any(axis=1)]
-                    months = treatment_data.columns
-                    percentages = (treatment_data.apply(lambda x: x.value_counts().get(treatment, 0)) / len(treatment_data)) * 100
-                    ax.plot(months, percentages, label=f'{treatment_label}', color=color)
+                for i, (treatment_label, color) in enumerate(zip(events_keys, colors)):
+                    ax.plot(months, percentages[i], label=f'{treatment_label}', color=color)
                 
                 ax.set_title(f'Cluster {cluster_label}')
                 ax.set_xlabel('Time')
@@ -100,29 +371,65 @@ class TCA:
     def calculate_distance_matrix(self, metric='hamming'):
         """
         Calculate the distance matrix for the treatment sequences.
+        The result for the last data and metric is kept: the returned array is read-only and shared by the
+        following calls on the same data, use distance_matrix.copy() to modify it.
 
         Parameters:
         metric (str): The distance metric to use. Default is 'hamming'.
 
         Returns:
-        distance_matrix (numpy.ndarray): A condensed distance matrix containing the pairwise distances between treatment sequences.
+        distance_matrix (numpy.ndarray): A condensed float32 distance matrix containing the pairwise distances between treatment sequences.
         """
-        distance_matrix = pdist(self.data, metric)
+        state_key, arr = self._states()
+        key = (metric, state_key)
+        if state_key[2] is not None and self._last_dist is not None and self._last_dist[0] == key:
+            return self._last_dist[1]
+
+        if metric == 'hamming':
+            if _pdist_hamming_int is not None and arr.dtype == np.int32:
+                distance_matrix = _pdist_hamming_int(_byte_codes(arr))
+            else:
+                distance_matrix = _hamming_packed(arr)
+            if distance_matrix is None:
+                distance_matrix = pdist(arr, 'hamming').astype(np.float32, copy=False)
+        else:
+            distance_matrix = pdist(arr, metric).astype(np.float32, copy=False)
+        # Shared by the following calls, so it must not be modified in place
+        distance_matrix.flags.writeable = False
+        self._last_dist = (key, distance_matrix) if state_key[2] is not None else None
         return distance_matrix
     
-    def cluster(self, distance_matrix, method='ward', optimal_ordering=True):
+    def cluster(self, distance_matrix, method='ward', optimal_ordering=False):
         """
         Perform hierarchical clustering on the distance matrix.
+        The fastcluster implementation is used when it is installed, scipy's otherwise.
+        The result for the last distances and parameters is kept: the returned array is read-only and shared by the
+        following calls with the same arguments, use linkage_matrix.copy() to modify it.
 
         Parameters:
         distance_matrix (numpy.ndarray): A condensed distance matrix containing the pairwise distances between treatment sequences.
         method (str): The linkage algorithm to use. Default is 'ward'.
         optimal_ordering (bool): If True, the linkage matrix will be reordered so that the distance between successive leaves is minimal.
+            Default is False, the reordering is expensive and often costs more than the linkage itself.
+            It can still be applied later with scipy.cluster.hierarchy.optimal_leaf_ordering(linkage_matrix, distance_matrix).
 
         Returns:
         linkage_matrix (numpy.ndarray): The linkage matrix containing the hierarchical clustering information.
         """
-        linkage_matrix = linkage(distance_matrix, method=method, optimal_ordering=optimal_ordering)
+        distance_matrix = np.asarray(distance_matrix)
+        digest = _digest(distance_matrix)
+        key = (distance_matrix.shape, distance_matrix.dtype.str, digest, method, optimal_ordering)
+        if digest is not None and self._last_linkage is not None and self._last_linkage[0] == key:
+            return self._last_linkage[1]
+
+        if _linkage is None:
+            linkage_matrix = linkage(distance_matrix, method=method, optimal_ordering=optimal_ordering)
+        else:
+            linkage_matrix = _linkage(distance_matrix, method=method, preserve_input=True)
+            if optimal_ordering:
+                linkage_matrix = optimal_leaf_ordering(linkage_matrix, distance_matrix)
+        linkage_matrix.flags.writeable = False
+        self._last_linkage = (key, linkage_matrix) if digest is not None else None
         return linkage_matrix
 
     def plot_dendrogram(self, linkage_matrix):
@@ -195,7 +502,7 @@ class TCA:
         Returns:
         numpy.ndarray: An array of cluster labels assigned to each patient.
         """
-        clusters = fcluster(linkage_matrix, num_clusters, criterion='maxclust')
+        clusters = fcluster(linkage_matrix, t=num_clusters, criterion='maxclust')
         return clusters
     
     def plot_cluster_heatmaps(self, clusters, leaves_order, sorted=True):
@@ -211,35 +518,38 @@ class TCA:
         None
         """
         # Reorder the data according to leaves_order
-        reordered_data = self.data.iloc[leaves_order]
+        leaves_order = np.asarray(leaves_order)
         reordered_clusters = clusters[leaves_order]
+        index = getattr(self.data, 'index', None)
+        arr = self._arr
+        patients = np.arange(len(arr)) if index is None else np.asarray(index)
 
         num_clusters = len(np.unique(clusters))
+        partition = _partition_by_cluster(reordered_clusters)
         cluster_data = {}
 
         for cluster_label in range(1, num_clusters + 1):
-            cluster_indices = np.where(reordered_clusters == cluster_label)[0]
-            cluster_df = reordered_data.iloc[cluster_indices]
+            cluster_indices = leaves_order[partition[cluster_label]]
             if sorted:
-                cluster_df = cluster_df.sort_values(by=cluster_df.columns.tolist())
-            cluster_data[cluster_label] = cluster_df
-
-        num_rows = (num_clusters + 1) // 2
-        num_cols = min(2, num_clusters)
-        fig, axs = plt.subplots(num_rows, num_cols, figsize=(15, 10))
-        if num_clusters == 2:
-            axs = np.array([axs])
-
-        for i, (cluster_label, cluster_df) in enumerate(cluster_data.items()):
-            row = i // num_cols
-            col = i % num_cols
-            sns.heatmap(cluster_df, cmap=self.colors, cbar=False, ax=axs[row, col])
-            axs[row, col].set_title(f'Heatmap du cluster {cluster_label}')
-            axs[row, col].set_xlabel('Time')
-            axs[row, col].set_ylabel('Patients')
-
-        if num_clusters % 2 != 0:
-            fig.delaxes(axs[-1, -1])
+                # Sort the rows by the first time step, then the second, ... (lexsort uses the last key first)
+                cluster_indices = cluster_indices[np.lexsort(arr[cluster_indices].T[::-1])]
+            cluster_data[cluster_label] = cluster_indices
+
+        cmap = self.colors if isinstance(self.colors, str) else ListedColormap(self.colors)
+        fig, axs = _cluster_grid(num_clusters)
+
+        for i, (cluster_label, cluster_indices) in enumerate(cluster_data.items()):
+            ax = axs.flat[i]
+            ax.imshow(arr[cluster_indices], cmap=cmap, aspect='auto', interpolation='nearest')
+            xticks = np.linspace(0, len(self._cols) - 1, min(len(self._cols), 6)).round().astype(int)
+            ax.set_xticks(xticks)
+            ax.set_xticklabels(self._cols[xticks], rotation=90)
+            yticks = np.linspace(0, len(cluster_indices) - 1, min(len(cluster_indices), 10)).round().astype(int)
+            ax.set_yticks(yticks)
+            ax.set_yticklabels(patients[cluster_indices][yticks])
+            ax.set_title(f'Heatmap du cluster {cluster_label}')
+            ax.set_xlabel('Time')
+            ax.set_ylabel('Patients')
 
         handles = [plt.Rectangle((0, 0), 1, 1, color=self.colors[i], label=self.state_label[i]) for i in range(len(self.state_label))]
         plt.legend(handles=handles, labels=self.state_label, loc='center', bbox_to_anchor=(-0.1, -0.6), ncol=len(self.state_label) // 2)
@@ -261,17 +571,11 @@ class TCA:
         None
         """
         if clusters is None:
-            df = self.data.copy()
-            # Initialize an empty list to store data for plotting
-            plot_data = []
-
-            # Collect data for each treatment
-            for treatment, treatment_label,color in zip(self.state_numeric, self.state_label,self.colors):
-                treatment_data = df[df.eq(treatment).any(axis=1)]
-                months = treatment_data.columns
-                percentages = (treatment_data.apply(lambda x: x.value_counts().get(treatment, 0)) / len(treatment_data)) * 100
-                plot_data.append(pd.DataFrame({'Month': months, 'Percentage': percentages, 'Treatment': treatment_label}))
-                plt.bar(months, percentages, label=f'{treatment_label}', color=color)
+            months = self._cols
+            # Compute the percentages of all the states at once, the loop only draws
+            percentages = _state_percentages(self._arr, np.asarray(self.state_numeric))
+            for i, (treatment_label, color) in enumerate(zip(self.state_label, self.colors)):
+                plt.bar(months, percentages[i], label=f'{treatment_label}', color=color)
 
             plt.title('Percentage of Patients under Each State Over Time')
             plt.xlabel('Time')
@@ -281,28 +585,17 @@ class TCA:
 
         else:
             num_clusters = len(np.unique(clusters))
-            num_rows = (num_clusters + 1) // 2  
-            num_cols = min(2, num_clusters)
-            fig, axs = plt.subplots(num_rows, num_cols, figsize=(15, 10))
-            if num_clusters == 2:
-                axs = np.array([axs])
-            if num_clusters % 2 != 0:
-                fig.delaxes(axs[-1, -1])
+            cluster_percentages = self._cluster_state_percentages(clusters)
+            months = self._cols
+            fig, axs = _cluster_grid(num_clusters)
 
             for cluster_label in range(1, num_clusters + 1):
-                cluster_indices = np.where(clusters == cluster_label)[0]
-                cluster_data = self.data.iloc[cluster_indices]
-
-                row = (cluster_label - 1) // num_cols
-                col = (cluster_label - 1) % num_cols
+                percentages = cluster_percentages[cluster_label - 1]
 
-                ax = axs[row, col]
+                ax = axs.flat[cluster_label - 1]
 
-                for treatment, treatment_label, color in zip(self.state_numeric, self.state_label, self.colors):
-                    treatment_data = cluster_data[cluster_data.eq(treatment).any(axis=1)]
-                    months = treatment_data.columns
-                    percentages = (treatment_data.apply(lambda x: x.value_counts().get(treatment, 0)) / len(treatment_data)) * 100
-                    ax.bar(months, percentages, label=f'{treatment_label}', color=color)
+                for i, (treatment_label, color) in enumerate(zip(self.state_label, self.colors)):
+                    ax.bar(months, percentages[i], label=f'{treatment_label}', color=color)
 
                 ax.set_title(f'Cluster {cluster_label}')
                 ax.set_xlabel('Time')
@@ -324,35 +617,20 @@ class TCA:
         None
         """
         num_clusters = len(np.unique(clusters))
-        num_rows = (num_clusters + 1) // 2  
-        num_cols = min(2, num_clusters)
-        fig, axs = plt.subplots(num_rows, num_cols, figsize=(15, 10))
-        if num_clusters == 2:
-            axs = np.array([axs])
-        if num_clusters % 2 != 0:
-            fig.delaxes(axs[-1, -1])
+        cluster_percentages = self._cluster_state_percentages(clusters)
+        # Each state is stacked on the cumulated percentages of the states before it
+        bottoms = np.zeros_like(cluster_percentages)
+        bottoms[:, 1:] = np.cumsum(cluster_percentages[:, :-1], axis=1)
+        fig, axs = _cluster_grid(num_clusters)
 
         for cluster_label in range(1, num_clusters + 1):
-            cluster_indices = np.where(clusters == cluster_label)[0]
-            cluster_data = self.data.iloc[cluster_indices]
-            
-            row = (cluster_label - 1) // num_cols
-            col = (cluster_label - 1) % num_cols
-            
-            ax = axs[row, col]
+            stacked_data = cluster_percentages[cluster_label - 1]
             
-            stacked_data = []
-            for treatment in self.state_numeric:
-                treatment_data = cluster_data[cluster_data.eq(treatment).any(axis=1)]
-                months = treatment_data.columns
-                percentages = (treatment_data.apply(lambda x: x.value_counts().get(treatment, 0)) / len(treatment_data)) * 100
-                stacked_data.append(percentages.values)
+            ax = axs.flat[cluster_label - 1]
             
-            months = range(len(months))
-            bottom = np.zeros(len(months))
+            months = range(len(self._cols))
             for i, data in enumerate(stacked_data):
-                ax.bar(months, data, bottom=bottom, label=self.state_label[i], color=self.colors[i])
-                bottom += data
+                ax.bar(months, data, bottom=bottoms[cluster_label - 1, i], label=self.state_label[i], color=self.colors[i])
             
             ax.set_title(f'Cluster {cluster_label}')
             ax.set_xlabel('Time')